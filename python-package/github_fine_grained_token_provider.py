@@ -1,52 +1,482 @@
 import asyncio
-from collections.abc import AsyncIterator
-from contextlib import asynccontextmanager
-from datetime import date, timedelta
+from collections.abc import AsyncIterator, Iterable, Mapping, Sequence
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass, field, replace
+from datetime import date, datetime, timedelta
+from functools import cache
+from itertools import chain
+from logging import getLogger
 from os import environ
 from pathlib import Path
-from sys import stderr
+from time import monotonic
+from typing import Any
 
+import aiohttp
+from bs4 import BeautifulSoup
 from github_fine_grained_token_client import (
     AllRepositories,
+    AnyPermissionKey,
     AsyncClientSession,
+    FineGrainedTokenBulkInfo,
     FineGrainedTokenIndividualInfo,
     GithubCredentials,
     PermissionValue,
     SelectRepositories,
     TokenNameError,
     TwoFactorOtpProvider,
-    async_client,
 )
 from github_fine_grained_token_client.common import Expired
-from github_fine_grained_token_client.permissions import permission_from_str
-from tfprovider.level2.attribute_path import ROOT
+from github_fine_grained_token_client.permissions import ALL_PERMISSION_KEYS
+from tfprovider.level2.attribute_path import ROOT, AttributePath
 from tfprovider.level2.diagnostics import Diagnostics
-from tfprovider.level2.wire_format import Unknown, UnrefinedUnknown
+from tfprovider.level2.wire_format import (
+    ImmutableMsgPackish,
+    StringWireType,
+    Unknown,
+    UnrefinedUnknown,
+)
+from tfprovider.level2.wire_marshaling import (
+    AttributeWireTypeMarshaler,
+    AttributeWireTypeUnmarshaler,
+    SetWireTypeUnmarshaler,
+)
 from tfprovider.level2.wire_representation import (
     DateAsStringWireRepresentation,
+    MaybeUnknownWireRepresentation,
     OptionalWireRepresentation,
+    SetWireRepresentation,
+    StringWireRepresentation,
+    WireRepresentation,
 )
 from tfprovider.level3.statically_typed_schema import attribute, attributes_class
 from tfprovider.level4.async_provider_servicer import PlanResourceChangeResponse
 from tfprovider.level4.async_provider_servicer import Provider as BaseProvider
 from tfprovider.level4.async_provider_servicer import Resource as BaseResource
 
+logger = getLogger(__name__)
+
+_ONE_DAY = timedelta(days=1)
+
+# shared instead of allocating a new empty set every time one is needed:
+_EMPTY: frozenset[Any] = frozenset()
+
+# there are only a few dozen possible permissions, so we can map their names
+# to what we pass to the client once here instead of on every apply:
+_READ_PAIRS = {key.value: (key, PermissionValue.READ) for key in ALL_PERMISSION_KEYS}
+_WRITE_PAIRS = {key.value: (key, PermissionValue.WRITE) for key in ALL_PERMISSION_KEYS}
+
+
+def _permissions_from_strs(
+    read_permissions: Iterable[str], write_permissions: Iterable[str]
+) -> dict[AnyPermissionKey, PermissionValue]:
+    try:
+        return dict(
+            chain(
+                (_READ_PAIRS[name] for name in read_permissions),
+                (_WRITE_PAIRS[name] for name in write_permissions),
+            )
+        )
+    except KeyError as e:
+        # same error as the client's permission_from_str would raise
+        raise KeyError(f"no permission found for string {e.args[0]!r}") from None
+
 
 class EnvTwoFactorOtpProvider(TwoFactorOtpProvider):
+    def __init__(self) -> None:
+        # read only once so that all OTP requests during a login get the same
+        # value, even if the environment changes in between
+        self.otp = environ.get("GITHUB_OTP")
+
     async def get_otp_for_user(self, username: str) -> str:
-        return environ["GITHUB_OTP"]
+        if self.otp is None:
+            raise KeyError("GITHUB_OTP")
+        return self.otp
 
 
-@asynccontextmanager
-async def credentialed_client() -> AsyncIterator[AsyncClientSession]:
+_PERSIST_PATH = Path("~/.github-token-client/persist").expanduser()
+
+
+@cache
+def _credentials() -> GithubCredentials:
     credentials = GithubCredentials(environ["GITHUB_USER"], environ["GITHUB_PASS"])
     assert credentials.username and credentials.password
-    async with async_client(
-        credentials=credentials,
-        two_factor_otp_provider=EnvTwoFactorOtpProvider(),
-        persist_to=Path("~/.github-token-client/persist").expanduser(),
-    ) as session:
-        yield session
+    return credentials
+
+
+class ThreadedParsingClientSession(AsyncClientSession):
+    """
+    Client session that parses GitHub's HTML pages in a worker thread.
+
+    Parsing a page takes long enough that doing it on the event loop would
+    hold up the requests made for other resources in the meantime.
+
+    Note that ``html.parser`` is pure Python and holds the GIL while parsing,
+    so the event loop only gets to run whenever the interpreter switches
+    threads and the overlap this buys is limited.
+    """
+
+    # overrides a private method of the client, which is why the client is
+    # pinned to a minor version in pyproject.toml
+    async def _get_parsed_response_html(
+        self, response: aiohttp.ClientResponse
+    ) -> BeautifulSoup:
+        response_text = await response.text()
+        return await asyncio.to_thread(BeautifulSoup, response_text, "html.parser")
+
+
+@asynccontextmanager
+async def credentialed_client(
+    two_factor_otp_provider: TwoFactorOtpProvider,
+) -> AsyncIterator[AsyncClientSession]:
+    # same as the client's own async_client() but with our session class:
+    async with aiohttp.ClientSession(raise_for_status=True) as http_session:
+        with ThreadedParsingClientSession.make_with_cookies_loaded(
+            http_session,
+            _credentials(),
+            two_factor_otp_provider,
+            _PERSIST_PATH,
+        ) as session:
+            yield session
+
+
+class CachedSession:
+    """
+    Wrapper around a client session that caches token information for a while.
+
+    Looking up a token means scraping several pages on GitHub, and Terraform
+    tends to ask about the same tokens repeatedly within one run.
+    """
+
+    def __init__(self, session: AsyncClientSession, ttl: float = 60) -> None:
+        self.session = session
+        self.ttl = ttl
+        self._index: tuple[dict[str, FineGrainedTokenBulkInfo], float] | None = None
+        self._index_lock = asyncio.Lock()
+        # bumped whenever the token list changes on GitHub's end, so that
+        # fetches which were already in flight at that point can tell their
+        # result is stale:
+        self._index_generation = 0
+        self._info_by_id: dict[int, tuple[FineGrainedTokenIndividualInfo, float]] = {}
+        self._pending_deletions: list[tuple[int, asyncio.Future[None]]] = []
+        self._deletion_lock = asyncio.Lock()
+
+    def _is_fresh(self, fetched_at: float) -> bool:
+        return monotonic() - fetched_at < self.ttl
+
+    async def ensure_token_index(self) -> dict[str, FineGrainedTokenBulkInfo]:
+        """
+        Token list by name, fetched with one request and shared by all callers.
+        """
+        # the lock makes concurrent callers wait for a single fetch instead of
+        # all fetching the list at the same time
+        async with self._index_lock:
+            while self._index is None or not self._is_fresh(self._index[1]):
+                generation = self._index_generation
+                index = {
+                    info.name: info for info in await self.session.get_tokens_bulk()
+                }
+                if generation == self._index_generation:
+                    self._index = (index, monotonic())
+            return self._index[0]
+
+    def invalidate_token_index(self) -> None:
+        self._index = None
+        self._index_generation += 1
+
+    async def get_token_info_by_id(
+        self, token_id: int
+    ) -> FineGrainedTokenIndividualInfo:
+        cached = self._info_by_id.get(token_id)
+        if cached is not None and self._is_fresh(cached[1]):
+            return cached[0]
+        token_info = await self.session.get_token_info_by_id(token_id)
+        self._info_by_id[token_id] = (token_info, monotonic())
+        return token_info
+
+    async def get_token_info_by_name(self, name: str) -> FineGrainedTokenIndividualInfo:
+        # looked up in the shared index so that refreshing N tokens doesn't
+        # mean fetching the token list N times
+        index = await self.ensure_token_index()
+        if name not in index:
+            raise KeyError(f"no token named {name!r}")
+        return await self.get_token_info_by_id(index[name].id)
+
+    async def get_token_id_by_name(self, name: str) -> int:
+        index = await self.ensure_token_index()
+        if name not in index:
+            # can be a list that was fetched concurrently and doesn't know
+            # about the token yet => ignore its TTL
+            self.invalidate_token_index()
+            index = await self.ensure_token_index()
+        if name not in index:
+            raise KeyError(f"no token named {name!r}")
+        return index[name].id
+
+    async def create_token(self, name: str, **kwargs: Any) -> str:
+        try:
+            return await self.session.create_token(name, **kwargs)
+        finally:
+            self.invalidate_token_index()
+
+    async def create_token_and_get_info(
+        self,
+        name: str,
+        expires: date | timedelta,
+        permissions: Mapping[AnyPermissionKey, PermissionValue] | None = None,
+        **kwargs: Any,
+    ) -> tuple[str, FineGrainedTokenIndividualInfo | None]:
+        """
+        Create a token and return its value together with its information.
+
+        The client doesn't tell us the ID of the token it just created, but we
+        already know everything else about it, so only the token list has to be
+        fetched afterwards instead of also the token's own pages.
+
+        The information is ``None`` if the token couldn't be found afterwards,
+        because the token exists at that point either way and its value must
+        not get lost.
+        """
+        token_value = await self.create_token(
+            name, expires=expires, permissions=permissions, **kwargs
+        )
+        try:
+            token_id = await self.get_token_id_by_name(name)
+        except Exception:
+            logger.exception("looking up newly created token %r failed", name)
+            return token_value, None
+        expires_date = (
+            date.today() + expires if isinstance(expires, timedelta) else expires
+        )
+        # only the ID comes from GitHub, the rest is what we asked for (and
+        # created is a guess), so this must not go into the info cache where
+        # it would be mistaken for what GitHub reports:
+        token_info = FineGrainedTokenIndividualInfo(
+            id=token_id,
+            name=name,
+            created=datetime.now(),
+            expires=datetime.combine(expires_date, datetime.min.time()),
+            permissions=permissions or {},
+        )
+        return token_value, token_info
+
+    async def delete_tokens_by_ids(
+        self, token_ids: Sequence[int]
+    ) -> list[BaseException | None]:
+        """
+        Delete several tokens, fetching the token list only once for all of them.
+
+        Returns:
+            For each token ID, the exception that occurred while deleting it
+            or ``None`` if it was deleted successfully.
+        """
+        # the list has to be fetched because it contains a separate deletion
+        # authenticity token for each token, so one fetch covers all of them
+        # (the client only offers this via internal methods, which is why it
+        # is pinned to a minor version in pyproject.toml)
+        try:
+            info_by_id = {
+                info.id: info for info in await self.session._get_tokens_bulk_internal()
+            }
+        except Exception as e:
+            return [e for _ in token_ids]
+
+        async def delete(token_id: int) -> None:
+            if token_id not in info_by_id:
+                raise KeyError(f"no token with ID {token_id!r}")
+            await self.session._delete_token_by_internal_info(info_by_id[token_id])
+
+        return await asyncio.gather(
+            *(delete(token_id) for token_id in token_ids), return_exceptions=True
+        )
+
+    async def _delete_token_by_id_batched(self, token_id: int) -> None:
+        # deletions requested while another batch is running are collected and
+        # performed together once it's done, so destroying N tokens doesn't
+        # mean fetching the token list N times
+        deleted = asyncio.get_running_loop().create_future()
+        entry = (token_id, deleted)
+        self._pending_deletions.append(entry)
+        try:
+            await self._deletion_lock.acquire()
+        except BaseException:
+            # cancelled while waiting => don't let a later batch perform the
+            # deletion anyway, and if one already is, don't let it resolve a
+            # future that nobody will ever look at
+            if entry in self._pending_deletions:
+                self._pending_deletions.remove(entry)
+            deleted.cancel()
+            raise
+        try:
+            if self._pending_deletions:
+                batch, self._pending_deletions = self._pending_deletions, []
+                try:
+                    errors = await self.delete_tokens_by_ids([id_ for id_, _ in batch])
+                except BaseException as e:
+                    # e.g. we got cancelled => don't leave the others waiting
+                    # forever, but don't cancel them either as nobody
+                    # cancelled *them*
+                    for _, batch_deleted in batch:
+                        if batch_deleted is not deleted and not batch_deleted.done():
+                            batch_deleted.set_exception(
+                                RuntimeError(f"batch deletion interrupted: {e!r}")
+                            )
+                    raise
+                for (_, batch_deleted), error in zip(batch, errors):
+                    if batch_deleted.done():
+                        continue
+                    if error is not None:
+                        batch_deleted.set_exception(error)
+                    else:
+                        batch_deleted.set_result(None)
+        finally:
+            self._deletion_lock.release()
+        await deleted
+
+    async def delete_token_by_id(self, token_id: int) -> None:
+        try:
+            await self._delete_token_by_id_batched(token_id)
+        except BaseException:
+            # no telling what state the token list is in now
+            self.invalidate_token_index()
+            raise
+        finally:
+            self._info_by_id.pop(token_id, None)
+        # a list fetched concurrently might still contain the deleted token:
+        self._index_generation += 1
+        # we know exactly what changed, so instead of making the next lookup
+        # fetch the whole list again, just drop the deleted token from it
+        if self._index is not None:
+            index, fetched_at = self._index
+            self._index = (
+                {name: info for name, info in index.items() if info.id != token_id},
+                fetched_at,
+            )
+
+
+_DEFAULT_MAX_CONCURRENCY = 4
+
+
+def _max_concurrency() -> int:
+    # called before the plugin handshake, where raising would just look like a
+    # crash to Terraform => fall back to something sane instead
+    value = environ.get("GITHUB_MAX_CONCURRENCY")
+    if value is None:
+        return _DEFAULT_MAX_CONCURRENCY
+    try:
+        max_concurrency = int(value)
+    except ValueError:
+        logger.warning(
+            "GITHUB_MAX_CONCURRENCY must be an integer but is %r, using %d",
+            value,
+            _DEFAULT_MAX_CONCURRENCY,
+        )
+        return _DEFAULT_MAX_CONCURRENCY
+    if max_concurrency < 1:
+        # a semaphore of 0 would make every operation hang forever
+        logger.warning(
+            "GITHUB_MAX_CONCURRENCY must be at least 1 but is %d, using 1",
+            max_concurrency,
+        )
+        return 1
+    return max_concurrency
+
+
+@dataclass
+class ProviderState:
+    """
+    State shared between the provider and its resources.
+
+    Holds a single client session that is reused across all operations of a
+    provider run, so we only log into GitHub once instead of on every call.
+    """
+
+    exit_stack: AsyncExitStack = field(default_factory=AsyncExitStack)
+    session_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    session: CachedSession | None = None
+    otp_provider: TwoFactorOtpProvider = field(default_factory=EnvTwoFactorOtpProvider)
+    # Terraform performs operations on several resources at once, but we don't
+    # want to hit GitHub with too many requests at the same time:
+    request_semaphore: asyncio.Semaphore = field(
+        default_factory=lambda: asyncio.Semaphore(_max_concurrency())
+    )
+
+    async def get_session(self) -> CachedSession:
+        async with self.session_lock:
+            if self.session is None:
+                # only handed over to the shared exit stack once logged in so
+                # that failed attempts don't leave HTTP sessions open
+                async with AsyncExitStack() as exit_stack:
+                    session = await exit_stack.enter_async_context(
+                        credentialed_client(self.otp_provider)
+                    )
+                    # log in right away while holding the lock so that
+                    # concurrent operations don't each try to perform their own
+                    # login
+                    await session.login()
+                    # cookies are otherwise only saved on exit, which a killed
+                    # process never gets to
+                    if (persisting := session._persisting_http_session) is not None:
+                        persisting.save()
+                    self.exit_stack.push_async_exit(exit_stack.pop_all())
+                self.session = CachedSession(session)
+            return self.session
+
+    async def aclose(self) -> None:
+        async with self.session_lock:
+            self.session = None
+            await self.exit_stack.aclose()
+
+
+class IntAsStringWireTypeUnmarshaler(AttributeWireTypeUnmarshaler[StringWireType, int]):
+    attribute_wire_type = StringWireType()
+
+    def unmarshal_msgpack(self, value: ImmutableMsgPackish) -> int:
+        if not isinstance(value, str):
+            raise TypeError(
+                f"expected string but got {value!r} which is of type {type(value)}"
+            )
+        return int(value)
+
+
+class IntAsStringWireTypeMarshaler(AttributeWireTypeMarshaler[StringWireType, int]):
+    attribute_wire_type = StringWireType()
+
+    def marshal_msgpack(self, value: Any) -> str:
+        if not isinstance(value, int):
+            raise TypeError(
+                f"expected int but got {value!r} which is of type {type(value)}"
+            )
+        return str(value)
+
+
+@dataclass
+class IntAsStringWireRepresentation(WireRepresentation[str, int]):
+    """
+    Representation converting an integer to a string.
+    """
+
+    attribute_wire_type: StringWireType = field(default=StringWireType())
+    unmarshaler: IntAsStringWireTypeUnmarshaler = field(
+        default=IntAsStringWireTypeUnmarshaler()
+    )
+    marshaler: IntAsStringWireTypeMarshaler = field(
+        default=IntAsStringWireTypeMarshaler()
+    )
+
+
+class FrozenSetWireTypeUnmarshaler(SetWireTypeUnmarshaler[Any, Any]):
+    def unmarshal_msgpack(self, value: ImmutableMsgPackish) -> frozenset[Any]:
+        return frozenset(super().unmarshal_msgpack(value))
+
+
+class FrozenSetWireRepresentation(SetWireRepresentation[Any, Any]):
+    """
+    Like `SetWireRepresentation` but unmarshaling to frozensets.
+    """
+
+    def __init__(self, inner: WireRepresentation[Any, Any]):
+        super().__init__(inner)
+        self.unmarshaler = FrozenSetWireTypeUnmarshaler(inner.unmarshaler)
 
 
 @attributes_class()
@@ -54,9 +484,15 @@ class ProviderConfig:
     pass
 
 
-@attributes_class()
+# slots because instances get created for every operation on every resource:
+@attributes_class(slots=True)
 class TokenResourceConfig:
-    id: str | None | Unknown = attribute(computed=True)
+    id: int | None | Unknown = attribute(
+        computed=True,
+        representation=MaybeUnknownWireRepresentation(
+            OptionalWireRepresentation(IntAsStringWireRepresentation())
+        ),
+    )
     # TODO as I only found out now, anything that users can stick variables
     #   into must be unknown-able, because the value given to planning when
     #   there is a variable in the attr config will be a refined unknown with
@@ -83,14 +519,31 @@ class TokenResourceConfig:
     #   (non-None) default when planning; so compute=True should be set
     #   automatically for anything with a non-None default.
     # TODO see above re: unknown
-    select_repositories: set[str | Unknown] | None = attribute(
-        default_factory=set, optional=True, computed=True
+    select_repositories: frozenset[str | Unknown] | None = attribute(
+        default_factory=frozenset,
+        optional=True,
+        computed=True,
+        representation=OptionalWireRepresentation(
+            FrozenSetWireRepresentation(
+                MaybeUnknownWireRepresentation(StringWireRepresentation())
+            )
+        ),
     )
-    read_permissions: set[str] | None = attribute(
-        default_factory=set, optional=True, computed=True
+    read_permissions: frozenset[str] | None = attribute(
+        default_factory=frozenset,
+        optional=True,
+        computed=True,
+        representation=OptionalWireRepresentation(
+            FrozenSetWireRepresentation(StringWireRepresentation())
+        ),
     )
-    write_permissions: set[str] | None = attribute(
-        default_factory=set, optional=True, computed=True
+    write_permissions: frozenset[str] | None = attribute(
+        default_factory=frozenset,
+        optional=True,
+        computed=True,
+        representation=OptionalWireRepresentation(
+            FrozenSetWireRepresentation(StringWireRepresentation())
+        ),
     )
 
 
@@ -98,20 +551,53 @@ def token_resource_config_from_token_info(
     token_info: FineGrainedTokenIndividualInfo,
 ) -> TokenResourceConfig:
     return TokenResourceConfig(
-        id=str(token_info.id),
+        id=token_info.id,
         name=token_info.name,
         expires=token_info.expires.date()
         if not isinstance(token_info.expires, Expired)
-        else date.today() - timedelta(days=1),
+        else date.today() - _ONE_DAY,
         # TODO not currently returned by GHFGTC => rely on state (overwritten
         #   by values from there at call site)
-        select_repositories=set(),
-        read_permissions=set(),
-        write_permissions=set(),
+        select_repositories=_EMPTY,
+        read_permissions=_EMPTY,
+        write_permissions=_EMPTY,
     )
 
 
-class TokenResource(BaseResource[None, TokenResourceConfig]):
+# changing any of these attributes requires replacing the token:
+_REPLACE_ATTRS = (
+    "name",
+    "expires",
+    "select_repositories",
+    "read_permissions",
+    "write_permissions",
+)
+_REPLACE_PATHS = {
+    attr_name: ROOT.attribute_name(attr_name) for attr_name in _REPLACE_ATTRS
+}
+
+
+def _paths_requiring_replacement(
+    prior_state: TokenResourceConfig | None,
+    proposed_new_state: TokenResourceConfig,
+) -> list[AttributePath]:
+    """
+    Paths of attributes whose changes mean the token has to be replaced.
+    """
+    if prior_state is None:
+        return []
+    # nothing changed at all is the common case (e.g. refreshes), which one
+    # comparison of all fields at once can tell us:
+    if prior_state == proposed_new_state:
+        return []
+    return [
+        _REPLACE_PATHS[attr_name]
+        for attr_name in _REPLACE_ATTRS
+        if getattr(prior_state, attr_name) != getattr(proposed_new_state, attr_name)
+    ]
+
+
+class TokenResource(BaseResource[ProviderState, TokenResourceConfig]):
     type_name = "githubfinetok_token"
     config_type = TokenResourceConfig
 
@@ -121,7 +607,7 @@ class TokenResource(BaseResource[None, TokenResourceConfig]):
     async def validate_resource_config(
         self, config: TokenResourceConfig, diagnostics: Diagnostics
     ) -> None:
-        print(f"vrc {config.name=}", file=stderr)
+        logger.debug("vrc config.name=%r", config.name)
 
     async def plan_resource_change(
         self,
@@ -133,45 +619,20 @@ class TokenResource(BaseResource[None, TokenResourceConfig]):
         if proposed_new_state is None:
             return proposed_new_state
         if proposed_new_state.expires is None:
-            proposed_new_state.expires = date.today() + timedelta(days=1)
+            proposed_new_state.expires = date.today() + _ONE_DAY
         if proposed_new_state.select_repositories is None:
-            proposed_new_state.select_repositories = set()
+            proposed_new_state.select_repositories = _EMPTY
         if proposed_new_state.read_permissions is None:
-            proposed_new_state.read_permissions = set()
+            proposed_new_state.read_permissions = _EMPTY
         if proposed_new_state.write_permissions is None:
-            proposed_new_state.write_permissions = set()
-        # TODO introduce convenience function for this:
-        if prior_state is not None and (
-            prior_state.name != proposed_new_state.name
-            or prior_state.expires != proposed_new_state.expires
-            or prior_state.select_repositories != proposed_new_state.select_repositories
-            or prior_state.read_permissions != proposed_new_state.read_permissions
-            or prior_state.write_permissions != proposed_new_state.write_permissions
-        ):
-            requires_replace = []
-            if prior_state.name != proposed_new_state.name:
-                requires_replace.append(ROOT.attribute_name("name"))
-            if prior_state.expires != proposed_new_state.expires:
-                requires_replace.append(ROOT.attribute_name("expires"))
-            if (
-                prior_state.select_repositories
-                != proposed_new_state.select_repositories
-            ):
-                requires_replace.append(ROOT.attribute_name("select_repositories"))
-            if prior_state.read_permissions != proposed_new_state.read_permissions:
-                requires_replace.append(ROOT.attribute_name("read_permissions"))
-            if prior_state.write_permissions != proposed_new_state.write_permissions:
-                requires_replace.append(ROOT.attribute_name("write_permissions"))
+            proposed_new_state.write_permissions = _EMPTY
+        requires_replace = _paths_requiring_replacement(prior_state, proposed_new_state)
+        if requires_replace or proposed_new_state.id is None:
             proposed_new_state.id = UnrefinedUnknown()
             proposed_new_state.value = UnrefinedUnknown()
-        else:
-            requires_replace = None
-            if proposed_new_state.id is None:
-                proposed_new_state.id = UnrefinedUnknown()
-                proposed_new_state.value = UnrefinedUnknown()
         return (
             (proposed_new_state, requires_replace)
-            if requires_replace is not None
+            if requires_replace
             else proposed_new_state
         )
 
@@ -183,57 +644,58 @@ class TokenResource(BaseResource[None, TokenResourceConfig]):
         diagnostics: Diagnostics,
     ) -> TokenResourceConfig | None:
         new_state = None
-        async with credentialed_client() as session:
-            if proposed_new_state is not None:
-                # proposed_new_state is based on config so this must hold:
-                assert config is not None
-                try:
-                    token_value = await session.create_token(
+        session = await self.provider_state.get_session()
+        if proposed_new_state is not None:
+            # proposed_new_state is based on config so this must hold:
+            assert config is not None
+            try:
+                async with self.provider_state.request_semaphore:
+                    token_value, token_info = await session.create_token_and_get_info(
                         proposed_new_state.name,
                         expires=proposed_new_state.expires
                         if proposed_new_state.expires is not None
-                        else timedelta(days=1),
+                        else _ONE_DAY,
                         scope=SelectRepositories(list(rs))
                         if (rs := proposed_new_state.select_repositories)
                         else AllRepositories(),  # TODO allow publ repos
-                        permissions={
-                            **{
-                                permission_from_str(
-                                    permission_name
-                                ): PermissionValue.READ
-                                for permission_name in (
-                                    proposed_new_state.read_permissions or set()
-                                )
-                            },
-                            **{
-                                permission_from_str(
-                                    permission_name
-                                ): PermissionValue.WRITE
-                                for permission_name in (
-                                    proposed_new_state.write_permissions or set()
-                                )
-                            },
-                        },
-                    )
-                    diagnostics.add_warning(f"created token: {token_value}")
-                    token_info = await session.get_token_info_by_name(
-                        proposed_new_state.name
+                        permissions=_permissions_from_strs(
+                            proposed_new_state.read_permissions or (),
+                            proposed_new_state.write_permissions or (),
+                        ),
                     )
-                except TokenNameError as e:
-                    diagnostics.add_error(f"not creating new token: {e}")
-                    return None
-                new_state = token_resource_config_from_token_info(token_info)
-                # TODO see comments on these in ^
-                new_state.select_repositories = config.select_repositories or set()
-                new_state.read_permissions = config.read_permissions or set()
-                new_state.write_permissions = config.write_permissions or set()
-                # not saved on GitHub so not part of token info either:
-                new_state.value = token_value
-            else:
-                if prior_state is None:
-                    return None
-                assert isinstance(prior_state.id, str), "bug"
-                await session.delete_token_by_id(int(prior_state.id))
+                diagnostics.add_warning(f"created token: {token_value}")
+            except TokenNameError as e:
+                diagnostics.add_error(f"not creating new token: {e}")
+                return None
+            if token_info is None:
+                diagnostics.add_error(
+                    f"created token {proposed_new_state.name!r} but couldn't "
+                    "look it up afterwards"
+                )
+                # keep the value in the state at least, the ID will be filled
+                # in by the next refresh:
+                return replace(proposed_new_state, id=None, value=token_value)
+            new_state = token_resource_config_from_token_info(token_info)
+            # TODO see comments on these in ^
+            new_state.select_repositories = config.select_repositories or _EMPTY
+            new_state.read_permissions = config.read_permissions or _EMPTY
+            new_state.write_permissions = config.write_permissions or _EMPTY
+            # not saved on GitHub so not part of token info either:
+            new_state.value = token_value
+        else:
+            if prior_state is None:
+                return None
+            async with self.provider_state.request_semaphore:
+                token_id = prior_state.id
+                if token_id is None:
+                    # happens if a created token couldn't be looked up, see ^
+                    try:
+                        token_id = await session.get_token_id_by_name(prior_state.name)
+                    except KeyError:
+                        diagnostics.add_warning("token not found, but thats ok")
+                        return None
+                assert isinstance(token_id, int), "bug"
+                await session.delete_token_by_id(token_id)
         return new_state
 
     async def upgrade_resource_state(
@@ -247,44 +709,57 @@ class TokenResource(BaseResource[None, TokenResourceConfig]):
     async def read_resource(
         self, current_state: TokenResourceConfig, diagnostics: Diagnostics
     ) -> TokenResourceConfig | None:
-        new_state = None
-        async with credentialed_client() as session:
-            try:
+        session = await self.provider_state.get_session()
+        try:
+            async with self.provider_state.request_semaphore:
                 token_info = await session.get_token_info_by_name(current_state.name)
-                new_state = token_resource_config_from_token_info(token_info)
-                # TODO see comments on these in ^
-                new_state.select_repositories = (
-                    current_state.select_repositories or set()
-                )
-                new_state.read_permissions = current_state.read_permissions or set()
-                new_state.write_permissions = current_state.write_permissions or set()
-                # the token value itself is not saved on GitHub's end so we
-                # *have to* take it from the current state:
-                new_state.value = current_state.value
-            except KeyError:
-                diagnostics.add_warning("token not found, but thats ok")
+        except KeyError:
+            diagnostics.add_warning("token not found, but thats ok")
+            return None
+        new_state = token_resource_config_from_token_info(token_info)
+        # TODO see comments on these in ^
+        new_state.select_repositories = current_state.select_repositories or _EMPTY
+        new_state.read_permissions = current_state.read_permissions or _EMPTY
+        new_state.write_permissions = current_state.write_permissions or _EMPTY
+        # the token value itself is not saved on GitHub's end so we
+        # *have to* take it from the current state:
+        new_state.value = current_state.value
         return new_state
 
     async def import_resource(
         self, id: str, diagnostics: Diagnostics
     ) -> TokenResourceConfig:
-        async with credentialed_client() as session:
-            token_info = await session.get_token_info_by_id(int(id))
-        return TokenResourceConfig(id=id, name=token_info.name)
+        # IDs given by users on import are the only ones not going through the
+        # attribute's wire representation:
+        token_id = int(id)
+        session = await self.provider_state.get_session()
+        async with self.provider_state.request_semaphore:
+            token_info = await session.get_token_info_by_id(token_id)
+        return TokenResourceConfig(id=token_id, name=token_info.name)
 
 
-class Provider(BaseProvider[None, ProviderConfig]):
-    provider_state = None
+class Provider(BaseProvider[ProviderState, ProviderConfig]):
     resource_factories = [TokenResource]
     config_type = ProviderConfig
 
     schema_version = 1
     block_version = 1
 
+    def __init__(self) -> None:
+        # must exist before the base class hands it to the resources:
+        self.provider_state = ProviderState()
+        super().__init__()
+
     async def validate_provider_config(
         self, config: ProviderConfig, diagnostics: Diagnostics
     ) -> None:
-        print("vpc", file=stderr)
+        logger.debug("vpc")
+
+    async def run(self) -> None:
+        try:
+            await super().run()
+        finally:
+            await self.provider_state.aclose()
 
 
 def main() -> None: